@@ -1,11 +1,16 @@
 #!/usr/bin/env python3
 # -*- coding: utf-8 -*-
 
+import atexit
+import contextlib
+import functools
 import json
 import logging
 import os
 import queue
 import random
+import re
+import select
 import shutil
 import signal
 import socket
@@ -14,9 +19,13 @@ import sys
 import tempfile
 import threading
 import time
+from concurrent.futures import Future, TimeoutError as FutureTimeout
 from datetime import datetime, time as dt_time
-from logging.handlers import RotatingFileHandler
+from logging.handlers import QueueHandler, QueueListener, RotatingFileHandler
 from pathlib import Path
+from types import MappingProxyType
+from typing import NamedTuple
+from urllib.parse import parse_qs, urlsplit
 
 # ----------------------------
 # Helpers
@@ -28,21 +37,99 @@ def _env_get(keys, default=None):
             return v
     return default
 
+_SAFE_TABLE = str.maketrans({
+    chr(i): "_" for i in range(128) if not (chr(i).isalnum() or chr(i) in "-_.@")
+})
+# \w == isalnum() o "_", así que equivale a la tabla para texto no ASCII
+_UNSAFE_RE = re.compile(r"[^\w.@-]")
+
+@functools.lru_cache(maxsize=None)
+def _which(name: str):
+    # PATH no cambia en runtime: un solo recorrido por binario
+    return shutil.which(name)
+
 def _safe_name(s: str) -> str:
-    out = []
-    for ch in str(s):
-        if ch.isalnum() or ch in ("-", "_", ".", "@"):
-            out.append(ch)
-        else:
-            out.append("_")
-    return "".join(out)[:80]
+    s = str(s)
+    if s.isascii():
+        return s.translate(_SAFE_TABLE)[:80]
+    return _UNSAFE_RE.sub("_", s)[:80]
 
-def _atomic_write_json(path: Path, data: dict):
+# orjson (opcional): mismo contrato que json pero en C y devolviendo bytes
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+# ijson (opcional): parseo incremental de playlists grandes
+try:
+    import ijson
+except ImportError:
+    ijson = None
+
+def _json_dumpb(obj, indent=False) -> bytes:
+    if orjson is not None:
+        opt = orjson.OPT_NON_STR_KEYS | (orjson.OPT_INDENT_2 if indent else 0)
+        return orjson.dumps(obj, option=opt)
+    if indent:
+        return json.dumps(obj, ensure_ascii=False, indent=2).encode("utf-8")
+    # mismo formato compacto que orjson
+    return json.dumps(obj, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+
+def _json_loads(data):
+    if orjson is not None:
+        try:
+            return orjson.loads(data)
+        except Exception:
+            pass
+    if isinstance(data, (bytes, bytearray, memoryview)):
+        data = bytes(data).decode("utf-8", errors="ignore")
+    return json.loads(data)
+
+# (epoch_s, "%Y-%m-%d %H:%M:%S", "%H:%M:%S"): strftime una vez por segundo.
+# Se reemplaza la tupla entera, así que un lector nunca ve campos mezclados.
+_ts_cache = (0, "", "")
+
+def _now_str():
+    global _ts_cache
+    c = _ts_cache
+    t = int(time.time())
+    if c[0] != t:
+        dt = datetime.fromtimestamp(t)
+        c = _ts_cache = (t, dt.strftime("%Y-%m-%d %H:%M:%S"), dt.strftime("%H:%M:%S"))
+    return c[1], c[2]
+
+_TMP_SUFFIX = f".tmp-{os.getpid()}"
+
+def _atomic_write_json(path: Path, data: dict, indent=False):
+    # compacto por defecto; indent solo para ficheros que edita una persona
     path.parent.mkdir(parents=True, exist_ok=True)
-    tmp = path.with_suffix(path.suffix + f".tmp-{os.getpid()}")
-    txt = json.dumps(data, ensure_ascii=False, indent=2)
-    tmp.write_text(txt, encoding="utf-8")
-    tmp.replace(path)
+    tmp = f"{path}{_TMP_SUFFIX}"
+    blob = memoryview(_json_dumpb(data, indent=indent))
+    fd = os.open(tmp, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+    try:
+        try:
+            while blob:
+                blob = blob[os.write(fd, blob):]
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+        os.replace(tmp, path)
+    except BaseException:
+        # SD llena / error de E/S: no dejar .tmp acumulándose junto al fichero
+        try:
+            os.unlink(tmp)
+        except OSError:
+            pass
+        raise
+    # fsync del directorio para que el rename sobreviva a un corte de luz
+    try:
+        dfd = os.open(path.parent, os.O_RDONLY | os.O_DIRECTORY)
+        try:
+            os.fsync(dfd)
+        finally:
+            os.close(dfd)
+    except OSError:
+        pass
 
 # ----------------------------
 # Logging
@@ -52,22 +139,33 @@ LOG_FILE = _env_get(
     os.path.join(tempfile.gettempdir(), "pabs-tv-client.log"),
 )
 
+_log_fmt = logging.Formatter("%(asctime)s [%(levelname)s] %(message)s")
+
 handlers = []
 try:
     fh = RotatingFileHandler(LOG_FILE, maxBytes=10 * 1024 * 1024, backupCount=2)
     fh.setLevel(logging.INFO)
+    fh.setFormatter(_log_fmt)
     handlers.append(fh)
 except Exception:
     pass
 
 sh = logging.StreamHandler(sys.stdout)
 sh.setLevel(logging.DEBUG)
+sh.setFormatter(_log_fmt)
 handlers.append(sh)
 
+# Los hilos solo encolan el registro; la escritura a stdout/fichero (y la
+# rotación) ocurre en el hilo del QueueListener, fuera de la reproducción.
+_log_queue = queue.SimpleQueue()
+_log_listener = QueueListener(_log_queue, *handlers, respect_handler_level=True)
+_log_listener.start()
+atexit.register(_log_listener.stop)  # vacía la cola de logs al salir (incluido sys.exit)
+
 logging.basicConfig(
     level=logging.DEBUG,
-    format="%(asctime)s [%(levelname)s] %(message)s",
-    handlers=handlers,
+    format="%(message)s",  # el formato final lo aplican fh/sh en el listener
+    handlers=[QueueHandler(_log_queue)],
 )
 log = logging.getLogger("pabs-tv")
 
@@ -86,11 +184,20 @@ except Exception:
 # ----------------------------
 HOSTNAME = socket.gethostname()
 CLIENT_ID = _env_get(["PABS_CLIENT_ID", "CLIENT_ID"], None)
+# solo un id configurado es estable entre reinicios (el de respaldo lleva el PID)
+CLIENT_ID_FIXED = bool(CLIENT_ID)
 if not CLIENT_ID:
     CLIENT_ID = f"sala-01-{HOSTNAME}-{os.getpid()}"
 
 MQTT_HOST = _env_get(["PABS_MQTT_HOST", "MQTT_BROKER", "MQTT_HOST"], "localhost")
 MQTT_PORT = int(_env_get(["PABS_MQTT_PORT", "MQTT_PORT"], "1883"))
+# sesión persistente (clean_session=False): opt-in y solo con CLIENT_ID fijo.
+# paho 1.6 manda el PUBACK al volver de on_message: un comando que tumbara el
+# proceso se reenviaría en cada reconexión, así que por defecto no se activa
+MQTT_PERSISTENT_SESSION = _env_get(["PABS_MQTT_PERSISTENT_SESSION"], "0").lower() in ("1", "true", "yes", "y")
+# por debajo del timeout de NAT típico (~30 s) para que el router no tire el
+# socket ocioso; a cambio, un PINGREQ más cada ~25 s
+MQTT_KEEPALIVE = int(_env_get(["PABS_MQTT_KEEPALIVE", "MQTT_KEEPALIVE"], "25"))
 MQTT_USER = _env_get(["PABS_MQTT_USER", "MQTT_USER", "MQTT_USERNAME"], "") or None
 MQTT_PASS = _env_get(["PABS_MQTT_PASS", "MQTT_PASSWORD", "MQTT_PASS"], "") or None
 
@@ -112,6 +219,13 @@ REMOTE_PLAYLIST_FILE = Path(
 PERSIST_REMOTE_PLAYLIST = _env_get(["PABS_PERSIST_REMOTE_PLAYLIST"], "1").lower() in ("1", "true", "yes", "y")
 OVERWRITE_LOCAL_PLAYLIST = _env_get(["PABS_OVERWRITE_LOCAL_PLAYLIST", "PABS_OVERWRITE_PLAYLIST_JSON"], "0").lower() in ("1", "true", "yes", "y")
 
+# PABS_HOT_DEBUG=1: log por mensaje MQTT y consola en DEBUG; si no, resumen por segundo
+HOT_DEBUG = _env_get(["PABS_HOT_DEBUG"], "0").lower() in ("1", "true", "yes", "y")
+sh.setLevel(logging.DEBUG if HOT_DEBUG else logging.INFO)
+
+# a partir de este tamaño la playlist se parsea en streaming (si hay ijson)
+PLAYLIST_STREAM_MIN_BYTES = int(_env_get(["PABS_PLAYLIST_STREAM_MIN_BYTES"], str(256 * 1024)))
+
 MEDIA_VIDEO_DIR = MEDIA_DIR / "videos"
 MEDIA_IMAGE_DIR = MEDIA_DIR / "images"
 for p in (MEDIA_VIDEO_DIR, MEDIA_IMAGE_DIR, CACHE_DIR):
@@ -139,8 +253,11 @@ log.info("==================")
 # ----------------------------
 # MPV
 # ----------------------------
-MPV = shutil.which("mpv") or "/usr/bin/mpv"
+MPV = _which("mpv") or "/usr/bin/mpv"
 MPV_LOG = _env_get(["PABS_MPV_LOGFILE"], "/tmp/mpv.log")
+# PABS_MPV_QUIET=1: sin --log-file (menos escritura en la SD); los errores de
+# reproducción llegan igual por IPC (end-file con reason=error)
+MPV_QUIET = _env_get(["PABS_MPV_QUIET"], "0").lower() in ("1", "true", "yes", "y")
 MPV_YTDL_FORMAT = _env_get(["PABS_MPV_YTDL_FORMAT"], "bestvideo[height<=720]+bestaudio/best/best")
 MPV_HWDEC = _env_get(["PABS_MPV_HWDEC"], "no")
 
@@ -163,7 +280,7 @@ MPV_BASE_OPTS = [
     "--idle=yes",
     "--volume=100",
     "--volume-max=100",
-    f"--log-file={MPV_LOG}",
+    "--msg-level=all=error" if MPV_QUIET else f"--log-file={MPV_LOG}",
     f"--ytdl-format={MPV_YTDL_FORMAT}",
     f"--hwdec={MPV_HWDEC}",
     f"--input-ipc-server={str(MPV_IPC_PATH)}",
@@ -181,6 +298,12 @@ if MPV_GPU_CONTEXT:
     MPV_BASE_OPTS.append(f"--gpu-context={MPV_GPU_CONTEXT}")
 if MPV_EXTRA_OPTS_RAW:
     MPV_BASE_OPTS.extend(MPV_EXTRA_OPTS_RAW.split())
+MPV_BASE_OPTS = tuple(MPV_BASE_OPTS)
+
+# cache en disco {url: {"fmt", "direct": [urls], "exp": epoch}} del fallback yt-dlp
+YTDL_CACHE_FILE = CACHE_DIR / "ytdl.json"
+_ytdl_cache = None
+_ytdl_cache_lock = threading.Lock()
 
 YTDL_FORMAT_TRIES = [
     "bestvideo[height<=720]+bestaudio/best/best",
@@ -188,6 +311,8 @@ YTDL_FORMAT_TRIES = [
     "bestvideo+bestaudio/best",
     "best",
 ]
+# tope por extracción: el subproceso se mata al vencer
+YTDL_TIMEOUT = 20
 
 # ----------------------------
 # State
@@ -195,6 +320,7 @@ YTDL_FORMAT_TRIES = [
 state_lock = threading.Lock()
 MODE_LOOP = "LOOP"
 MODE_DIRECT = "DIRECT"
+SRC_NONE = "ninguno"
 
 state = {
     "mode": MODE_LOOP,
@@ -205,7 +331,7 @@ state = {
     "loop_shuffle": False,
     "retries": 0,
     "current_item": None,
-    "current_src": "ninguno",
+    "current_src": SRC_NONE,
     "paused": False,
     "last_error": None,
     "show_time": False,
@@ -217,101 +343,402 @@ state = {
     "mqtt_connected": False,
 }
 
+# Vista inmutable del estado: get_state() la devuelve sin lock ni copia;
+# set_state() la reconstruye (pocas escrituras, muchas lecturas).
+_state_view = MappingProxyType(dict(state))
+
 stop_all_event = threading.Event()
-loop_should_run = threading.Event()
-direct_queue = queue.Queue()
-schedule_change_event = threading.Event()
+_shutdown_evt = threading.Event()
+# refleja state["paused"] para los contadores de imagen/negro (sin lock)
+paused_event = threading.Event()
+# un productor (on_message) y un consumidor (direct_thread_fn)
+direct_queue = queue.SimpleQueue()
+_SHUTDOWN = object()  # centinela de cierre para direct_queue y _mqtt_out_q
 
 mpv_proc = None
 mpv_lock = threading.Lock()
-mpv_ipc_lock = threading.Lock()
+
+# Propiedades observadas (observe_property). El hilo lector de MpvIpc vuelca
+# los cambios en _mpv_props y despierta a quien espere en _mpv_cond.
+MPV_OBSERVED_PROPS = ("eof-reached", "idle-active", "pause")
+_mpv_cond = threading.Condition()
+_mpv_props = {}
+
+# Estado de reproducción, protegido por _mpv_cond y cambiado solo por
+# _playback_transition(). Cada orden que interrumpe (next, play.once, loop.*)
+# incrementa la generación; quien reproduce compara con la que capturó al empezar.
+_play_gen = 0
+_loop_gen = 0  # cambia con cada orden de loop (start/stop/...): la pasada en curso se reinicia
+_loop_enabled = False
+_play_tls = threading.local()
 
 mqtt_connected_evt = threading.Event()
 
+# Cola de salida MQTT: publish() encola y un único hilo publica en ráfagas
+_mqtt_out_q = queue.SimpleQueue()
+_TCP_CORK = getattr(socket, "TCP_CORK", None)
+
+WORKER_STACK_SIZE = 512 * 1024
+
+HEARTBEAT_INTERVAL = 300
+HEARTBEAT_JITTER = 15
+
 # ----------------------------
 # MQTT helpers
 # ----------------------------
-def publish(client, topic, payload, retain=False):
+def publish(client, topic, payload, retain=False, qos=None):
     try:
-        payload_json = json.dumps(payload, ensure_ascii=False)
+        payload_json = _json_dumpb(payload)
     except Exception as e:
         log.error("[MQTT][SEND] json error (%s): %s", topic, e)
         return
+    _publish_bytes(client, topic, payload_json, retain, qos)
+
+def _publish_bytes(client, topic, payload_json, retain=False, qos=None):
+    # qos por defecto: 1 para estado retenido, 0 para eventos transitorios (sin PUBACK)
+    if qos is None:
+        qos = 1 if retain else 0
+    if HOT_DEBUG and log.isEnabledFor(logging.DEBUG):
+        log.debug("[MQTT][SEND] %s | %s", topic, payload_json.decode("utf-8", errors="replace"))
+    _mqtt_out_q.put((client, topic, payload_json, qos, bool(retain)))
+
+@contextlib.contextmanager
+def mqtt_cork(client, enabled=True):
+    """
+    TCP_CORK (Linux) sobre el socket de paho durante una ráfaga: los PUBLISH
+    salen juntos en el menor número de segmentos al descorchar.
+    """
+    sock = None
+    if enabled and _TCP_CORK is not None:
+        try:
+            sock = client.socket()
+            if sock is not None:
+                sock.setsockopt(socket.IPPROTO_TCP, _TCP_CORK, 1)
+        except Exception:
+            sock = None
     try:
-        log.info("[MQTT][SEND] %s | %s", topic, payload_json)
-        return client.publish(topic, payload_json, qos=1, retain=bool(retain))
-    except Exception as e:
-        log.error("[MQTT][SEND] publish error (%s): %s", topic, e)
+        yield
+    finally:
+        if sock is not None:
+            try:
+                sock.setsockopt(socket.IPPROTO_TCP, _TCP_CORK, 0)
+            except Exception:
+                pass
+
+def _heartbeat_deadline():
+    return time.monotonic() + HEARTBEAT_INTERVAL + random.uniform(-HEARTBEAT_JITTER, HEARTBEAT_JITTER)
+
+def mqtt_publisher_thread_fn(mqttc):
+    """
+    Publica la cola en ráfagas y emite también el heartbeat (sin hilo propio).
+    El log de envíos es un resumen por topic como mucho una vez por segundo.
+    Heartbeat con jitter para no alinear a toda la flota; si dentro de la
+    ventana de jitter sale otra ráfaga, el heartbeat va justo detrás de ella.
+    Al cerrar, _SHUTDOWN en la cola lo despierta sin esperar al heartbeat.
+    """
+    next_hb = _heartbeat_deadline()
+    sent = {}  # topic -> mensajes desde el último resumen
+    next_summary = time.monotonic() + 1.0
+    while True:
+        try:
+            deadline = min(next_hb, next_summary) if sent else next_hb
+            batch = [_mqtt_out_q.get(timeout=max(0.0, deadline - time.monotonic()))]
+        except queue.Empty:
+            batch = []
+        try:
+            while True:
+                batch.append(_mqtt_out_q.get_nowait())
+        except queue.Empty:
+            pass
+        stopping = _shutdown_evt.is_set()
+        if stopping:
+            batch = [m for m in batch if m is not _SHUTDOWN]
+        with mqtt_cork(mqttc, len(batch) > 1):
+            for client, topic, payload_json, qos, retain in batch:
+                try:
+                    client.publish(topic, payload_json, qos=qos, retain=retain)
+                    sent[topic] = sent.get(topic, 0) + 1
+                except Exception as e:
+                    log.error("[MQTT][SEND] publish error (%s): %s", topic, e)
+        if sent and time.monotonic() >= next_summary:
+            log.info("[MQTT][SEND] %s", ", ".join(f"{t}={n}" for t, n in sent.items()))
+            sent.clear()
+            next_summary = time.monotonic() + 1.0
+        if stopping:
+            return
+        if time.monotonic() >= next_hb - (HEARTBEAT_JITTER if batch else 0):
+            publish_status_snapshot(mqttc, event="heartbeat")
+            next_hb = _heartbeat_deadline()
+
+def flush_publishes():
+    # vacía la cola en el hilo actual (cierre ordenado)
+    try:
+        while True:
+            item = _mqtt_out_q.get_nowait()
+            if item is _SHUTDOWN:
+                continue
+            client, topic, payload_json, qos, retain = item
+            try:
+                client.publish(topic, payload_json, qos=qos, retain=retain)
+            except Exception as e:
+                log.error("[MQTT][SEND] publish error (%s): %s", topic, e)
+    except queue.Empty:
+        pass
 
 def set_state(**kwargs):
+    global _state_view
     with state_lock:
         state.update(kwargs)
+        _state_view = MappingProxyType(dict(state))
+        if "paused" in kwargs:
+            if kwargs["paused"]:
+                paused_event.set()
+            else:
+                paused_event.clear()
+    if "paused" in kwargs:
+        _mpv_wake()
 
 def get_state():
-    with state_lock:
-        return dict(state)
+    return _state_view
+
+# Foto de estado sin extras: forma fija, se rellena la plantilla en vez de pasar
+# por el encoder JSON. event/timestamp/mode son internos (ASCII sin escapes);
+# src sí se codifica como JSON.
+_SNAPSHOT_FMT = (
+    b'{"event":"%s","timestamp":"%s","mode":"%s","client_id":'
+    + _json_dumpb(CLIENT_ID).replace(b"%", b"%%")
+    + b',"src":%s,"paused":%s,"mqtt_connected":%s}'
+)
+_JSON_BOOL = {False: b"false", True: b"true"}
+_last_status_payload = None
 
-def publish_status_snapshot(mqttc, event="status"):
+def publish_status_snapshot(mqttc, event="status", force=False, **extra):
+    # extra: campos propios del evento que viajan en el mismo mensaje que la foto de estado
+    global _last_status_payload
     st = get_state()
+    if not extra:
+        payload_json = _SNAPSHOT_FMT % (
+            event.encode(),
+            _now_str()[0].encode(),
+            str(st.get("mode", MODE_LOOP)).encode(),
+            _json_dumpb(st.get("current_src", SRC_NONE)),
+            _JSON_BOOL[bool(st.get("paused", False))],
+            _JSON_BOOL[bool(st.get("mqtt_connected", False))],
+        )
+        # idéntico byte a byte (mismo segundo, mismo estado): el retenido ya lo tiene
+        if payload_json == _last_status_payload and not force:
+            return
+        _last_status_payload = payload_json
+        _publish_bytes(mqttc, TOPIC_STATUS, payload_json, retain=True)
+        return
     payload = {
         "event": event,
-        "timestamp": datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
+        "timestamp": _now_str()[0],
         "mode": st.get("mode", MODE_LOOP),
         "client_id": CLIENT_ID,
-        "src": st.get("current_src", "ninguno"),
+        "src": st.get("current_src", SRC_NONE),
         "paused": bool(st.get("paused", False)),
         "mqtt_connected": bool(st.get("mqtt_connected", False)),
     }
+    payload.update(extra)
+    _last_status_payload = None
     publish(mqttc, TOPIC_STATUS, payload, retain=True)
 
 # ----------------------------
 # MPV IPC
 # ----------------------------
-def _mpv_ipc_send(cmd_obj: dict, timeout=1.0):
-    import socket as pysocket
-    if not MPV_IPC_PATH.exists():
-        return None, "ipc_socket_missing"
+# Tramas precalculadas para los comandos fijos más frecuentes (solo falta el request_id)
+_MPV_FRAMES = {
+    tuple(cmd): b'{"command":' + _json_dumpb(cmd) + b',"request_id":%d}\n'
+    for cmd in (
+        ["stop"],
+        ["quit"],
+        ["set_property", "pause", True],
+        ["set_property", "pause", False],
+        ["set_property", "volume", 100],
+        ["set_property", "mute", False],
+    )
+}
 
-    with mpv_ipc_lock:
-        s = pysocket.socket(pysocket.AF_UNIX, pysocket.SOCK_STREAM)
-        s.settimeout(timeout)
-        try:
-            s.connect(str(MPV_IPC_PATH))
-            msg = (json.dumps(cmd_obj) + "\n").encode("utf-8")
-            s.sendall(msg)
-            data = s.recv(65535)
-            if not data:
-                return None, "no_response"
+def _mpv_frame(command, rid: int) -> bytes:
+    try:
+        tpl = _MPV_FRAMES.get(tuple(command))
+    except TypeError:
+        tpl = None
+    if tpl is not None:
+        return tpl % rid
+    return _json_dumpb({"command": command, "request_id": rid}) + b"\n"
+
+class MpvIpc:
+    """
+    Conexión persistente al socket IPC de mpv.
+    Cada comando lleva un request_id y el hilo lector entrega la respuesta
+    al Future correspondiente; los eventos van a _mpv_props.
+    """
+
+    def __init__(self, path: Path):
+        self.path = path
+        self._lock = threading.Lock()
+        self._sock = None
+        self._pending = {}
+        self._next_id = 0
+
+    @property
+    def connected(self) -> bool:
+        return self._sock is not None
+
+    def connect(self) -> bool:
+        with self._lock:
+            if self._sock is not None:
+                return True
+            s = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
             try:
-                return json.loads(data.decode("utf-8", errors="ignore")), None
+                s.connect(str(self.path))
             except Exception:
-                return None, "bad_response"
+                s.close()
+                return False
+            self._sock = s
+        with _mpv_cond:
+            _mpv_props.clear()
+            _mpv_props["connected"] = True
+        threading.Thread(target=self._reader_fn, args=(s,), daemon=True).start()
+        for i, prop in enumerate(MPV_OBSERVED_PROPS, 1):
+            self.send(["observe_property", i, prop])
+        return True
+
+    def send(self, command) -> Future:
+        return self.send_many([command])[0]
+
+    def send_many(self, commands):
+        """Envía varios comandos en un único write; un Future por comando."""
+        futs = [Future() for _ in commands]
+        with self._lock:
+            if self._sock is None:
+                for fut in futs:
+                    fut.set_exception(ConnectionError("ipc_not_connected"))
+                return futs
+            rids = []
+            frames = []
+            for command, fut in zip(commands, futs):
+                self._next_id += 1
+                rids.append(self._next_id)
+                self._pending[self._next_id] = fut
+                frames.append(_mpv_frame(command, self._next_id))
+            try:
+                self._sock.sendall(b"".join(frames))
+            except Exception as e:
+                for rid, fut in zip(rids, futs):
+                    self._pending.pop(rid, None)
+                    fut.set_exception(e)
+        return futs
+
+    def _reader_fn(self, sock):
+        try:
+            for line in sock.makefile("rb"):
+                try:
+                    msg = _json_loads(line)
+                except Exception:
+                    continue
+                if not isinstance(msg, dict):
+                    continue
+                if "event" in msg:
+                    self._on_event(msg)
+                    continue
+                with self._lock:
+                    fut = self._pending.pop(msg.get("request_id"), None)
+                if fut is not None:
+                    fut.set_result(msg)
         except Exception as e:
-            return None, str(e)
+            log.warning("[MPV] socket IPC cerrado: %s", e)
         finally:
+            with self._lock:
+                if self._sock is sock:
+                    self._sock = None
+                pending, self._pending = self._pending, {}
+            for fut in pending.values():
+                fut.set_exception(ConnectionError("ipc_closed"))
+            with _mpv_cond:
+                _mpv_props.clear()
+                _mpv_cond.notify_all()
             try:
-                s.close()
+                sock.close()
             except Exception:
                 pass
 
-def _mpv_get_property(prop: str):
-    resp, err = _mpv_ipc_send({"command": ["get_property", prop]}, timeout=0.6)
-    if err is not None or not isinstance(resp, dict):
-        return None
-    return resp.get("data")
+    def _on_event(self, msg):
+        ev = msg.get("event")
+        with _mpv_cond:
+            if ev == "property-change":
+                _mpv_props[msg.get("name")] = msg.get("data")
+            elif ev == "start-file":
+                # el archivo nuevo arranca: descartar el estado del anterior
+                _mpv_props.update({"file-started": True, "eof-reached": False, "idle-active": False, "end-file": None})
+            elif ev == "end-file":
+                _mpv_props["end-file"] = reason = msg.get("reason") or "unknown"
+                if reason == "error":
+                    log.warning("[MPV] error de reproducción: %s", msg.get("file_error") or "desconocido")
+            else:
+                return
+            _mpv_cond.notify_all()
+
+mpv_ipc = MpvIpc(MPV_IPC_PATH)
+
+def _mpv_ipc_send(cmd_obj: dict, timeout=1.0):
+    if not mpv_ipc.connected:
+        if not MPV_IPC_PATH.exists():
+            return None, "ipc_socket_missing"
+        if not mpv_ipc.connect():
+            return None, "ipc_connect_failed"
+    try:
+        return mpv_ipc.send(cmd_obj["command"]).result(timeout), None
+    except FutureTimeout:
+        return None, "timeout"
+    except Exception as e:
+        return None, str(e) or e.__class__.__name__
+
+def _mpv_wake():
+    # despierta esperas en _mpv_cond (p.ej. tras stop_all_event.set())
+    with _mpv_cond:
+        _mpv_cond.notify_all()
+
+def _playback_transition(abort=True, loop=None, **state_kw):
+    """
+    Cambio de modo en un solo paso: actualiza el estado, aborta lo que suena
+    (nueva generación), activa/desactiva el loop y despierta una vez a los hilos.
+    El stop sale aquí, con _mpv_cond tomado: ningún hilo puede cargar antes que
+    él, y el que se despierta sustituido no manda un stop a ciegas después.
+    Devuelve (_play_gen, _loop_gen) ya actualizados.
+    """
+    global _play_gen, _loop_gen, _loop_enabled
+    if state_kw:
+        set_state(**state_kw)
+    with _mpv_cond:
+        if abort:
+            _play_gen += 1
+            # sin esperar respuesta (no bloquear con el lock tomado)
+            mpv_ipc.send(["stop"])
+        if loop is not None:
+            _loop_gen += 1
+            _loop_enabled = bool(loop)
+        _mpv_cond.notify_all()
+        return _play_gen, _loop_gen
+
+def _playback_aborted():
+    return stop_all_event.is_set() or getattr(_play_tls, "gen", _play_gen) != _play_gen
 
 def _mpv_set_property(prop: str, value):
     resp, err = _mpv_ipc_send({"command": ["set_property", prop, value]}, timeout=1.0)
     return err is None
 
 def mpv_set_pause(paused: bool) -> bool:
-    with mpv_lock:
-        global mpv_proc
-        resp, err = _mpv_ipc_send({"command": ["set_property", "pause", bool(paused)]}, timeout=1.0)
-        if err is None:
-            set_state(paused=bool(paused))
-            return True
+    # el IPC va fuera de mpv_lock: MpvIpc ya serializa sus escrituras, y una
+    # respuesta lenta no debe bloquear el arranque/parada de mpv
+    resp, err = _mpv_ipc_send({"command": ["set_property", "pause", bool(paused)]}, timeout=1.0)
+    if err is None:
+        set_state(paused=bool(paused))
+        return True
 
+    with mpv_lock:
         # fallback SIGSTOP/SIGCONT si IPC falla
         if mpv_proc is not None:
             try:
@@ -347,12 +774,57 @@ def mpv_quit() -> bool:
 def _mpv_stop_playback():
     _mpv_ipc_send({"command": ["stop"]}, timeout=1.0)
 
+# inotify vía libc (solo Linux); en otros sistemas se sondea el path
+_IN_CREATE = 0x00000100
+try:
+    import ctypes
+    import ctypes.util
+    _libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+    _libc.inotify_init1
+    _libc.inotify_add_watch
+except Exception:
+    _libc = None
+
+def _wait_for_path(path: Path, timeout: float) -> bool:
+    deadline = time.monotonic() + timeout
+    fd = -1
+    if _libc is not None:
+        try:
+            fd = _libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+            if fd >= 0 and _libc.inotify_add_watch(fd, str(path.parent).encode(), _IN_CREATE) < 0:
+                os.close(fd)
+                fd = -1
+        except Exception:
+            fd = -1
+    delay = 0.02
+    try:
+        # el watch va antes del exists(): no se pierde un IN_CREATE intermedio
+        while True:
+            if path.exists():
+                return True
+            left = deadline - time.monotonic()
+            if left <= 0:
+                return False
+            if fd < 0:
+                # sin inotify: sondeo con backoff exponencial (20 ms .. 200 ms)
+                time.sleep(min(delay, left))
+                delay = min(delay * 2, 0.2)
+                continue
+            if select.select([fd], [], [], left)[0]:
+                try:
+                    os.read(fd, 4096)
+                except BlockingIOError:
+                    pass
+    finally:
+        if fd >= 0:
+            os.close(fd)
+
 def _ensure_mpv_running():
     global mpv_proc
     with mpv_lock:
         if mpv_proc is not None:
             if mpv_proc.poll() is None:
-                return True
+                return mpv_ipc.connect()
             mpv_proc = None
 
         try:
@@ -369,100 +841,150 @@ def _ensure_mpv_running():
             mpv_proc = None
             return False
 
-    t0 = time.time()
-    while time.time() - t0 < 3.0:
-        if MPV_IPC_PATH.exists():
-            _mpv_set_property("volume", 100)
-            _mpv_set_property("mute", False)
-            return True
-        time.sleep(0.02)
+    deadline = time.monotonic() + 3.0
+    if _wait_for_path(MPV_IPC_PATH, 3.0):
+        # el socket puede existir un instante antes del listen()
+        delay = 0.005
+        while True:
+            if mpv_ipc.connect():
+                _mpv_set_property("volume", 100)
+                _mpv_set_property("mute", False)
+                return True
+            left = deadline - time.monotonic()
+            if left <= 0:
+                break
+            time.sleep(min(delay, left))
+            delay = min(delay * 2, 0.2)
 
     log.warning("[MPV] mpv inició pero no apareció el socket IPC")
     return False
 
-def _mpv_loadfile(src: str, start_at=None):
+def _mpv_loadfile(src: str, start_at=None, image_duration=None):
     if not _ensure_mpv_running():
         return False
 
-    _mpv_set_property("volume", 100)
-    _mpv_set_property("mute", False)
-    _mpv_set_property("pause", False)
-
+    load = ["loadfile", src, "replace"]
     if start_at:
-        resp, err = _mpv_ipc_send({"command": ["loadfile", src, "replace", f"start={start_at}"]}, timeout=1.0)
+        load.append(f"start={start_at}")
+
+    # volume/mute/pause + loadfile en un solo write; solo importa la respuesta del loadfile
+    cmds = [
+        ["set_property", "volume", 100],
+        ["set_property", "mute", False],
+        ["set_property", "pause", False],
+    ]
+    if image_duration is not None:
+        # propiedad global de mpv: se confirma antes del loadfile (ida y vuelta extra
+        # solo para imágenes) para no cargar con la duración de otra imagen
+        cmds.append(["set_property", "image-display-duration", image_duration])
     else:
-        resp, err = _mpv_ipc_send({"command": ["loadfile", src, "replace"]}, timeout=1.0)
-
-    if err is None:
+        cmds.append(load)
+    try:
+        # comprobar y enviar bajo _mpv_cond: un hilo ya sustituido no llega a cargar
+        # encima del item nuevo (_playback_transition cambia la generación con el lock)
+        with _mpv_cond:
+            if _playback_aborted():
+                return False
+            _mpv_props["file-started"] = False
+            fut = mpv_ipc.send_many(cmds)[-1]
+        if image_duration is not None:
+            resp = fut.result(1.0)
+            if resp.get("error") != "success":
+                log.warning("[MPV] image-display-duration=%s rechazado: %s", image_duration, resp.get("error"))
+                return False
+            with _mpv_cond:
+                if _playback_aborted():
+                    return False
+                fut = mpv_ipc.send(load)
+        fut.result(1.0)
         return True
+    except FutureTimeout:
+        err = "timeout"
+    except Exception as e:
+        err = str(e) or e.__class__.__name__
 
     log.warning("[MPV] loadfile error: %s", err)
     return False
 
 def _wait_until_end():
     """
-    FIX: no dependemos solo de idle-active.
-    Detectamos fin por eof-reached=True.
+    Espera por eventos de mpv (observe_property + start-file/end-file) en vez
+    de sondear eof-reached / idle-active por IPC.
     """
-    while True:
-        if stop_all_event.is_set():
-            _mpv_stop_playback()
-            return "stopped"
-
-        eof = _mpv_get_property("eof-reached")
-        if eof is True:
-            # dejar mpv idle para siguiente item
-            _mpv_stop_playback()
-            return "eof"
-
-        idle = _mpv_get_property("idle-active")
-        if idle is True:
-            return "idle"
-
-        time.sleep(0.2)
+    def _done():
+        if _playback_aborted() or not _mpv_props.get("connected"):
+            return True
+        if not _mpv_props.get("file-started"):
+            return False
+        return (_mpv_props.get("eof-reached") is True
+                or _mpv_props.get("idle-active") is True
+                or _mpv_props.get("end-file") is not None)
+
+    with _mpv_cond:
+        _mpv_cond.wait_for(_done)
+        props = dict(_mpv_props)
+
+    if _playback_aborted():
+        # el stop ya lo mandó _playback_transition; aquí pisaría al nuevo dueño
+        return "stopped"
+    if not props.get("connected"):
+        return "error"
+    if props.get("end-file") == "error":
+        return "error"
+    if props.get("eof-reached") is True or props.get("end-file") == "eof":
+        # dejar mpv idle para siguiente item
+        _mpv_stop_playback()
+        return "eof"
+    return "idle"
 
 # ----------------------------
 # Media / Playback
 # ----------------------------
+_ABS_PREFIXES = ("/", "http://", "https://")
+_KIND_DIRS = {"video": MEDIA_VIDEO_DIR, "image": MEDIA_IMAGE_DIR}
+
 def build_media_path(src, kind):
     if not src:
         return src
-    if src.startswith("/") or src.startswith("http://") or src.startswith("https://"):
+    if src.startswith(_ABS_PREFIXES) or "/" in src or "\\" in src:
         return src
-    if "/" in src or "\\" in src:
-        return src
-    if kind == "video":
-        return str(MEDIA_VIDEO_DIR / src)
-    if kind == "image":
-        return str(MEDIA_IMAGE_DIR / src)
-    return src
+    d = _KIND_DIRS.get(kind)
+    return str(d / src) if d is not None else src
+
+def _wait_unpaused(seconds: float) -> bool:
+    """
+    Espera `seconds` sin contar el tiempo en pausa. Bloquea en _mpv_cond
+    (lo despiertan set_state(paused=...) y _mpv_wake()), sin sondeo.
+    Devuelve False si se interrumpió (stop_all_event o cambio de generación).
+    """
+    remaining = seconds
+    with _mpv_cond:
+        while remaining > 0 and not _playback_aborted():
+            # FIX: si está pausado, NO descontar tiempo
+            if paused_event.is_set():
+                _mpv_cond.wait()
+                continue
+            t0 = time.monotonic()
+            _mpv_cond.wait(timeout=remaining)
+            remaining -= time.monotonic() - t0
+    return not _playback_aborted()
+
+def _image_duration(duration, default=8.0):
+    # número positivo y finito; si no (0, negativo, texto, NaN), el de por defecto
+    try:
+        d = float(duration)
+    except (TypeError, ValueError):
+        return default
+    return d if 0 < d < float("inf") else default
 
 def play_image_persistent(src, duration):
-    ok = _mpv_loadfile(src)
+    # mpv cuenta la duración (respetando la pausa) y avisa con eof como un video
+    ok = _mpv_loadfile(src, image_duration=_image_duration(duration))
     if not ok:
         return False
 
-    remaining = float(int(duration or 8))
-    last = time.monotonic()
-
-    while remaining > 0:
-        if stop_all_event.is_set():
-            _mpv_stop_playback()
-            return False
-
-        st = get_state()
-        now = time.monotonic()
-        dt = now - last
-        last = now
-
-        # FIX: si está pausado, NO descontar tiempo
-        if not st.get("paused", False):
-            remaining -= dt
-
-        time.sleep(0.05)
-
-    _mpv_stop_playback()
-    return True
+    res = _wait_until_end()
+    return res in ("eof", "idle")
 
 def play_video_persistent(src, start_at=None):
     ok = _mpv_loadfile(src, start_at=start_at)
@@ -472,97 +994,228 @@ def play_video_persistent(src, start_at=None):
     res = _wait_until_end()
     return res in ("eof", "idle")
 
+def _ytdl_cache_get(url):
+    global _ytdl_cache
+    with _ytdl_cache_lock:
+        if _ytdl_cache is None:
+            try:
+                _ytdl_cache = _json_loads(YTDL_CACHE_FILE.read_bytes())
+            except Exception:
+                _ytdl_cache = {}
+        ent = _ytdl_cache.get(url)
+    if isinstance(ent, dict) and float(ent.get("exp") or 0) > time.time() + 60:
+        return ent
+    return None
+
+def _ytdl_cache_put(url, fmt, urls):
+    # googlevideo firma las URLs con expire=<epoch>; si no, ~4 h
+    exps = []
+    for du in urls:
+        parts = urlsplit(du)
+        v = parse_qs(parts.query).get("expire") or re.findall(r"/expire/(\d+)", parts.path)
+        if v and str(v[0]).isdigit():
+            exps.append(int(v[0]))
+    now = time.time()
+    exp = min(exps) if exps else now + 4 * 3600
+    with _ytdl_cache_lock:
+        cache = {k: v for k, v in (_ytdl_cache or {}).items() if isinstance(v, dict) and float(v.get("exp") or 0) > now}
+        cache[url] = {"fmt": fmt, "direct": list(urls), "exp": exp}
+        _ytdl_cache_write(cache)
+
+def _ytdl_cache_drop(url):
+    with _ytdl_cache_lock:
+        cache = dict(_ytdl_cache or {})
+        if cache.pop(url, None) is not None:
+            _ytdl_cache_write(cache)
+
+def _ytdl_cache_write(cache):
+    global _ytdl_cache
+    _ytdl_cache = cache
+    try:
+        _atomic_write_json(YTDL_CACHE_FILE, cache)
+    except Exception as e:
+        log.warning("[YOUTUBE] no se pudo guardar cache yt-dlp: %s", e)
+
+def _play_direct_urls(urls, start_at=None):
+    for du in urls:
+        # interrumpido (play.next/play.once): no pisar lo que cargó el nuevo dueño
+        if _playback_aborted():
+            return False
+        ok2 = _mpv_loadfile(du, start_at=start_at)
+        if ok2:
+            res = _wait_until_end()
+            if res in ("eof", "idle"):
+                return True
+    return False
+
+def _ytdl_get_urls(ytdlp, fmt, url):
+    """
+    URLs directas de `url` para el formato `fmt`, vía ejecutable: el timeout
+    mata el subproceso, así que una extracción nunca queda colgada (en proceso
+    no habría forma de cortarla, y competiría por el GIL con MQTT/reproducción).
+    """
+    out = subprocess.check_output([ytdlp, "-f", fmt, "--get-url", url], text=True, stderr=subprocess.STDOUT, timeout=YTDL_TIMEOUT)
+    return [l.strip() for l in out.splitlines() if l.strip()]
+
+def _ytdl_submit(ytdlp, fmt, url) -> Future:
+    # hilo daemon por extracción: no retiene el cierre del intérprete
+    fut = Future()
+
+    def _run():
+        try:
+            fut.set_result(_ytdl_get_urls(ytdlp, fmt, url))
+        except Exception as e:
+            fut.set_exception(e)
+
+    threading.Thread(target=_run, daemon=True).start()
+    return fut
+
+def _wait_future(fut, deadline):
+    """
+    Resultado de `fut`, o None si falla, vence `deadline` (monotonic) o se
+    interrumpe la reproducción.
+    """
+    fut.add_done_callback(lambda _f: _mpv_wake())
+    with _mpv_cond:
+        _mpv_cond.wait_for(
+            lambda: fut.done() or _playback_aborted(),
+            timeout=max(0.0, deadline - time.monotonic()),
+        )
+    if not fut.done():
+        return None
+    try:
+        return fut.result(0)
+    except Exception:
+        return None
+
 def play_youtube_persistent(url, start_at=None):
     ok = _mpv_loadfile(url, start_at=start_at)
     if ok:
         res = _wait_until_end()
         return res in ("eof", "idle")
+    if _playback_aborted():
+        return False
+
+    # URLs directas ya resueltas por yt-dlp (siguen vigentes durante horas)
+    cached = _ytdl_cache_get(url)
+    if cached:
+        log.info("[YOUTUBE] usando URL directa en cache (%s): %s", cached.get("fmt"), url)
+        if _play_direct_urls(cached.get("direct") or [], start_at=start_at):
+            return True
+        if _playback_aborted():
+            return False
+        _ytdl_cache_drop(url)
 
     # fallback yt-dlp
     log.warning("[YOUTUBE] mpv directo falló, intentando fallback yt-dlp: %s", url)
-    ytdlp = shutil.which("yt-dlp") or shutil.which("youtube-dl")
+    ytdlp = _which("yt-dlp") or _which("youtube-dl")
     if not ytdlp:
         log.error("[YOUTUBE] yt-dlp/youtube-dl no encontrado")
         return False
 
-    for fmt in YTDL_FORMAT_TRIES:
-        try:
-            out = subprocess.check_output([ytdlp, "-f", fmt, "--get-url", url], text=True, stderr=subprocess.STDOUT, timeout=20)
-            urls = [l.strip() for l in out.splitlines() if l.strip()]
-            for du in urls:
-                ok2 = _mpv_loadfile(du, start_at=start_at)
-                if ok2:
-                    res = _wait_until_end()
-                    if res in ("eof", "idle"):
-                        return True
-        except Exception:
+    # todas las extracciones corren a la vez (peor caso ~20 s, no 4x20 s),
+    # pero se consumen en orden de preferencia de formato
+    deadline = time.monotonic() + YTDL_TIMEOUT
+    futs = [_ytdl_submit(ytdlp, fmt, url) for fmt in YTDL_FORMAT_TRIES]
+    for fmt, fut in zip(YTDL_FORMAT_TRIES, futs):
+        if _playback_aborted():
+            return False
+        urls = _wait_future(fut, deadline)
+        if not urls:
             continue
+        if _playback_aborted():
+            return False
+        if _play_direct_urls(urls, start_at=start_at):
+            _ytdl_cache_put(url, fmt, urls)
+            return True
 
     return False
 
 # ----------------------------
 # TV power control (igual que antes)
 # ----------------------------
+def _tv_tvservice(exe, state_req):
+    cmd = [exe, "-p"] if state_req == "on" else [exe, "-o"]
+    res = subprocess.run(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE, timeout=10)
+    out = (res.stdout or b"").decode("utf-8", errors="ignore").strip()
+    err = (res.stderr or b"").decode("utf-8", errors="ignore").strip()
+    if res.returncode == 0:
+        return True, out or "tvservice success"
+    log.warning("[TV] tvservice falló: %s", err or out)
+    return False, err or out or "tvservice failed"
+
+def _tv_vcgencmd(exe, state_req):
+    power_val = "1" if state_req == "on" else "0"
+    res = subprocess.run([exe, "display_power", power_val], stdout=subprocess.PIPE, stderr=subprocess.PIPE, timeout=10)
+    out = (res.stdout or b"").decode("utf-8", errors="ignore").strip()
+    err = (res.stderr or b"").decode("utf-8", errors="ignore").strip()
+    if res.returncode == 0 and "not registered" not in (out + err).lower():
+        return True, out or "vcgencmd success"
+    return False, err or out or "vcgencmd failed"
+
+def _tv_xset(exe, state_req):
+    cmd = [exe, "dpms", "force", "on"] if state_req == "on" else [exe, "dpms", "force", "off"]
+    res = subprocess.run(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE, timeout=10)
+    if res.returncode == 0:
+        return True, "xset dpms success"
+    return False, "xset failed"
+
+def _tv_cec(exe, state_req):
+    cmd = [exe, "-s", "-d", "1"]
+    inp = "on 0\n" if state_req == "on" else "standby 0\n"
+    res = subprocess.run(cmd, input=inp, text=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE, timeout=10)
+    out = (res.stdout or "").strip()
+    err = (res.stderr or "").strip()
+    combined = (out + "\n" + err).lower()
+    bad = any(p in combined for p in ["cec_transmit failed", "failed to open", "no device", "errno="])
+    if res.returncode == 0 and not bad:
+        return True, out or "cec success"
+    return False, err or out or "cec failed"
+
+# Orden de preferencia = orden de la tupla.
+_TV_BACKENDS = (
+    ("tvservice", _which("tvservice"), _tv_tvservice),
+    ("vcgencmd", _which("vcgencmd"), _tv_vcgencmd),
+    ("xset", _which("xset"), _tv_xset),
+    ("cec", _which("cec-client"), _tv_cec),
+)
+# último backend que funcionó; se prueba primero en la siguiente llamada
+_tv_working_backend = None
+
 def tv_power_control(state_req):
-    state_req = (state_req or "").lower()
+    # state_req ya normalizado en minúsculas ("on"/"off")
+    global _tv_working_backend
     if state_req not in ("on", "off"):
         return False, "invalid state"
 
     cec_only = os.environ.get("PABS_TV_CEC_ONLY", "0") in ("1", "true", "True")
 
-    if not cec_only:
-        tvs = shutil.which("tvservice")
-        if tvs:
-            try:
-                cmd = [tvs, "-p"] if state_req == "on" else [tvs, "-o"]
-                res = subprocess.run(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE, timeout=10)
-                out = (res.stdout or b"").decode("utf-8", errors="ignore").strip()
-                err = (res.stderr or b"").decode("utf-8", errors="ignore").strip()
-                if res.returncode == 0:
-                    return True, out or "tvservice success"
-                log.warning("[TV] tvservice falló: %s", err or out)
-            except Exception as e:
-                log.error("[TV] tvservice excepción: %s", e)
-
-        vcgen = shutil.which("vcgencmd")
-        if vcgen:
-            try:
-                power_val = "1" if state_req == "on" else "0"
-                res = subprocess.run([vcgen, "display_power", power_val], stdout=subprocess.PIPE, stderr=subprocess.PIPE, timeout=10)
-                out = (res.stdout or b"").decode("utf-8", errors="ignore").strip()
-                err = (res.stderr or b"").decode("utf-8", errors="ignore").strip()
-                if res.returncode == 0 and "not registered" not in (out + err).lower():
-                    return True, out or "vcgencmd success"
-            except Exception as e:
-                log.error("[TV] vcgencmd excepción: %s", e)
-
-        xset = shutil.which("xset")
-        if xset and os.environ.get("DISPLAY"):
-            try:
-                cmd = [xset, "dpms", "force", "on"] if state_req == "on" else [xset, "dpms", "force", "off"]
-                res = subprocess.run(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE, timeout=10)
-                if res.returncode == 0:
-                    return True, "xset dpms success"
-            except Exception as e:
-                log.error("[TV] xset excepción: %s", e)
+    backends = []
+    for name, exe, fn in _TV_BACKENDS:
+        if not exe or (cec_only and name != "cec"):
+            continue
+        if name == "xset" and not os.environ.get("DISPLAY"):
+            continue
+        if name == _tv_working_backend:
+            backends.insert(0, (name, exe, fn))
+        else:
+            backends.append((name, exe, fn))
 
-    cec = shutil.which("cec-client")
-    if cec:
+    result = (False, "no method available")
+    for name, exe, fn in backends:
         try:
-            cmd = [cec, "-s", "-d", "1"]
-            inp = "on 0\n" if state_req == "on" else "standby 0\n"
-            res = subprocess.run(cmd, input=inp, text=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE, timeout=10)
-            out = (res.stdout or "").strip()
-            err = (res.stderr or "").strip()
-            combined = (out + "\n" + err).lower()
-            bad = any(p in combined for p in ["cec_transmit failed", "failed to open", "no device", "errno="])
-            if res.returncode == 0 and not bad:
-                return True, out or "cec success"
-            return False, err or out or "cec failed"
+            ok, detail = fn(exe, state_req)
         except Exception as e:
-            return False, str(e)
+            log.error("[TV] %s excepción: %s", name, e)
+            ok, detail = False, str(e)
+        if ok:
+            _tv_working_backend = name
+            return True, detail
+        if name == "cec":
+            result = (False, detail)
 
-    return False, "no method available"
+    _tv_working_backend = None
+    return result
 
 # ----------------------------
 # Schedule helpers
@@ -579,28 +1232,74 @@ def parse_time_str(time_str):
     except Exception:
         return None
 
-def is_within_schedule(start_time_str, end_time_str):
-    if not start_time_str and not end_time_str:
-        return True
-
-    start_t = parse_time_str(start_time_str)
-    end_t = parse_time_str(end_time_str)
+def time_str_to_mod(time_str):
+    """ "HH:MM" -> minuto del día (int), o None si no es válido. """
+    t = parse_time_str(time_str)
+    return None if t is None else t.hour * 60 + t.minute
 
-    if not start_t:
+def is_within_schedule_mod(start_mod, end_mod):
+    """
+    ¿La hora local cae dentro del horario? start_mod/end_mod son minutos del
+    día (ver time_str_to_mod); sin inicio siempre es True, sin fin vale desde
+    el inicio, y si fin < inicio el horario cruza la medianoche.
+    """
+    if start_mod is None:
         return True
 
-    now = datetime.now().time()
+    lt = time.localtime()
+    now = lt.tm_hour * 3600 + lt.tm_min * 60 + lt.tm_sec
+    start_s = start_mod * 60
+
+    if end_mod is None:
+        return now >= start_s
 
-    if not end_t:
-        return now >= start_t
+    end_s = end_mod * 60
+    if start_s <= end_s:
+        return start_s <= now <= end_s
+    return now >= start_s or now <= end_s
 
-    if start_t <= end_t:
-        return start_t <= now <= end_t
-    return now >= start_t or now <= end_t
+def seconds_until_mod(mod):
+    """ Segundos (hora local) hasta el próximo inicio del minuto del día `mod`. """
+    lt = time.localtime()
+    now = lt.tm_hour * 3600 + lt.tm_min * 60 + lt.tm_sec + (time.time() % 1)
+    return (mod * 60 - now) % 86400
 
 # ----------------------------
 # Playlist normalize/load/persist
 # ----------------------------
+def _normalize_item(it):
+    if not isinstance(it, dict):
+        return None
+    if "kind" not in it and "type" in it:
+        it["kind"] = it.pop("type")
+    return it
+
+_PLAYLIST_DEFAULTS = {
+    "shuffle": False,
+    "black_between": 0,
+    "retries": 0,
+    "show_time": False,
+    "schedule_enabled": False,
+    "schedule_start": None,
+    "schedule_end": None,
+}
+
+def _playlist_defaults(data):
+    # las playlists ya persistidas traen todas las claves: se salta el relleno
+    if not data.keys() >= _PLAYLIST_DEFAULTS.keys():
+        for k, v in _PLAYLIST_DEFAULTS.items():
+            data.setdefault(k, v)
+    # horario precompilado a minutos del día (se recalcula siempre desde los strings)
+    data["schedule_start_mod"] = time_str_to_mod(data["schedule_start"])
+    data["schedule_end_mod"] = time_str_to_mod(data["schedule_end"])
+    return data
+
+# claves precompiladas solo de memoria: no se escriben a disco
+_PLAYLIST_INTERNAL_KEYS = frozenset(("schedule_start_mod", "schedule_end_mod"))
+
+def _playlist_for_disk(data):
+    return {k: v for k, v in data.items() if k not in _PLAYLIST_INTERNAL_KEYS}
+
 def normalize_playlist(data):
     if not isinstance(data, dict):
         return {"items": []}
@@ -608,34 +1307,126 @@ def normalize_playlist(data):
     if "items" not in data and "list" in data:
         data["items"] = data.pop("list")
 
+    # en sitio: la lista solo se reconstruye si hay entradas inválidas
     items = data.get("items") or []
-    norm_items = []
+    if not isinstance(items, list):
+        items = list(items)
+    valid = True
     for it in items:
-        if not isinstance(it, dict):
+        if _normalize_item(it) is None:
+            valid = False
+    if not valid:
+        items = [it for it in items if isinstance(it, dict)]
+
+    data["items"] = items
+    return _playlist_defaults(data)
+
+def _load_playlist_stream(f):
+    """
+    Parseo incremental (ijson) para playlists grandes: cada item de "items"
+    se normaliza al salir del parser, sin pasar por la lista cruda completa.
+    """
+    data = None
+    items = None
+    key = None
+    builder = builder_prefix = None
+
+    for prefix, event, value in ijson.parse(f, use_float=True):
+        if builder is not None:
+            builder.event(event, value)
+            if prefix == builder_prefix and event in ("end_map", "end_array"):
+                if builder_prefix == "items.item":
+                    it = _normalize_item(builder.value)
+                    if it is not None:
+                        items.append(it)
+                else:
+                    data[key] = builder.value
+                builder = None
             continue
-        if "kind" not in it and "type" in it:
-            it["kind"] = it.pop("type")
-        norm_items.append(it)
-
-    data["items"] = norm_items
-    data.setdefault("shuffle", False)
-    data.setdefault("black_between", 0)
-    data.setdefault("retries", 0)
-    data.setdefault("show_time", False)
-    data.setdefault("schedule_enabled", False)
-    data.setdefault("schedule_start", None)
-    data.setdefault("schedule_end", None)
-    return data
+
+        if prefix == "":
+            if event == "start_map" and data is None:
+                data = {}
+            elif event == "map_key":
+                key = value
+            continue
+        if data is None:
+            continue
+
+        if key == "items" and items is None and event == "start_array" and prefix == "items":
+            items = []
+            continue
+        if key == "items" and items is not None:
+            # items que no son objeto se descartan (igual que normalize_playlist)
+            if prefix == "items.item" and event in ("start_map", "start_array"):
+                builder, builder_prefix = ijson.ObjectBuilder(), prefix
+                builder.event(event, value)
+            continue
+
+        if prefix == key:
+            if event in ("start_map", "start_array"):
+                builder, builder_prefix = ijson.ObjectBuilder(), prefix
+                builder.event(event, value)
+            else:
+                data[key] = value
+
+    if data is not None and items is not None:
+        data["items"] = items
+        return _playlist_defaults(data)
+    # sin array "items": mismo camino que normalize_playlist ("list" legado, etc.)
+    return normalize_playlist(data)
+
+# (path, mtime_ns, size) -> playlist normalizada; el loop relee el mismo
+# archivo en cada vuelta. Los resultados son compartidos: no mutarlos.
+_PLAYLIST_CACHE = {}
+_PLAYLIST_CACHE_MAX = 4
 
 def load_playlist_from_file(path: Path):
-    with open(path, "r", encoding="utf-8") as f:
-        raw = json.load(f)
-    return normalize_playlist(raw)
+    path = os.fspath(path)  # un solo str para stat/open/clave
+    st = os.stat(path)
+    key = (path, st.st_mtime_ns, st.st_size)
+    hit = _PLAYLIST_CACHE.get(key)
+    if hit is not None:
+        return hit
+
+    if ijson is not None and st.st_size > PLAYLIST_STREAM_MIN_BYTES:
+        with open(path, "rb") as f:
+            playlist = _load_playlist_stream(f)
+    else:
+        with open(path, "rb") as f:
+            playlist = normalize_playlist(_json_loads(f.read()))
+
+    _PLAYLIST_CACHE[key] = playlist
+    while len(_PLAYLIST_CACHE) > _PLAYLIST_CACHE_MAX:
+        _PLAYLIST_CACHE.pop(next(iter(_PLAYLIST_CACHE)))
+    return playlist
+
+# Buzón de una sola plaza para el hilo escritor: si llega otra playlist
+# mientras se escribe la anterior, la pendiente se sobrescribe (gana la última).
+_persist_slot = [None]
+_persist_lock = threading.Lock()
+_persist_evt = threading.Event()
 
 def persist_remote_playlist(playlist: dict):
+    # playlist ya normalizada por el llamador; se comparte sin copiar (no mutarla)
     if not PERSIST_REMOTE_PLAYLIST:
         return
-    pl = normalize_playlist(dict(playlist))
+    with _persist_lock:
+        _persist_slot[0] = playlist
+        _persist_evt.set()
+
+def persist_thread_fn():
+    while True:
+        _persist_evt.wait()
+        with _persist_lock:
+            pl = _persist_slot[0]
+            _persist_slot[0] = None
+            _persist_evt.clear()
+        if pl is not None:
+            _write_remote_playlist(pl)
+
+def _write_remote_playlist(pl: dict):
+    pl = _playlist_for_disk(pl)
     try:
         _atomic_write_json(REMOTE_PLAYLIST_FILE, pl)
         log.info("[PLAYLIST] Guardada playlist remota: %s", REMOTE_PLAYLIST_FILE)
@@ -644,11 +1435,19 @@ def persist_remote_playlist(playlist: dict):
 
     if OVERWRITE_LOCAL_PLAYLIST:
         try:
-            _atomic_write_json(LOCAL_PLAYLIST_FILE, pl)
+            _atomic_write_json(LOCAL_PLAYLIST_FILE, pl, indent=True)
             log.info("[PLAYLIST] (overwrite) Guardada también en local: %s", LOCAL_PLAYLIST_FILE)
         except Exception as e:
             log.error("[PLAYLIST] Error overwrite local: %s", e)
 
+@functools.lru_cache(maxsize=128)
+def _resolve_playlist_path(s: str) -> Path:
+    # resolve() toca el disco; las mismas rutas se repiten en cada loop.start/pasada
+    pf = Path(s).expanduser()
+    if not pf.is_absolute():
+        pf = (PROJECT_DIR / pf).resolve()
+    return pf
+
 def choose_boot_playlist_file() -> Path:
     try:
         if REMOTE_PLAYLIST_FILE.exists():
@@ -660,7 +1459,11 @@ def choose_boot_playlist_file() -> Path:
 # ----------------------------
 # Playback handlers
 # ----------------------------
-def handle_item_play(item, retries, publish_fn=None, show_time=False):
+def handle_item_play(item, retries, gen, publish_fn=None, show_time=False, **state_kw):
+    # gen: _play_gen leído por el llamador bajo _mpv_cond junto con su propia
+    # comprobación (pasada/job); releer el global aquí dejaría una ventana
+    # state_kw: campos extra de estado que se fijan junto con el item (una sola escritura)
+    _play_tls.gen = gen
     it = item
     kind = it.get("kind")
     src = it.get("src")
@@ -668,16 +1471,19 @@ def handle_item_play(item, retries, publish_fn=None, show_time=False):
     start = it.get("start_at")
 
     full_path = build_media_path(src, kind)
-    set_state(current_src=full_path or "ninguno", paused=False)
+    with _mpv_cond:
+        # ya sustituido: no pisar el estado del nuevo dueño
+        if _playback_aborted():
+            return "stopped"
+        set_state(current_item=it, current_src=full_path or SRC_NONE, paused=False, **state_kw)
 
     for _attempt in range(int(retries or 0) + 1):
-        if stop_all_event.is_set():
-            _mpv_stop_playback()
+        if _playback_aborted():
             return "stopped"
 
         payload_start = {"event": "start", "item": it}
         if show_time:
-            payload_start["timestamp"] = datetime.now().strftime("%H:%M:%S")
+            payload_start["timestamp"] = _now_str()[1]
         if publish_fn:
             publish_fn(payload_start)
 
@@ -691,13 +1497,15 @@ def handle_item_play(item, retries, publish_fn=None, show_time=False):
 
         payload_end = {"event": "end", "item": it, "ok": bool(ok)}
         if show_time:
-            payload_end["timestamp"] = datetime.now().strftime("%H:%M:%S")
+            payload_end["timestamp"] = _now_str()[1]
         if publish_fn:
             publish_fn(payload_end)
 
         if ok:
             return "ok"
-        time.sleep(0.5)
+        with _mpv_cond:
+            if _mpv_cond.wait_for(_playback_aborted, timeout=0.5):
+                return "stopped"
 
     return "error"
 
@@ -709,41 +1517,54 @@ def loop_thread_fn(mqttc):
     _ensure_mpv_running()
 
     while True:
-        loop_should_run.wait()
+        with _mpv_cond:
+            _mpv_cond.wait_for(lambda: _loop_enabled)
+            gen = _loop_gen
+
+        def _pass_changed():
+            # loop desactivado o nueva orden de loop (loop.start, play.once...);
+            # play.next solo aborta el item y la pasada sigue con el siguiente
+            return not _loop_enabled or _loop_gen != gen
+
+        def _pass_wait(timeout):
+            with _mpv_cond:
+                _mpv_cond.wait_for(_pass_changed, timeout=timeout)
+
         set_state(loop_running=True, mode=MODE_LOOP)
-        schedule_change_event.clear()
 
         st = get_state()
         path_str = st.get("loop_playlist_file") or str(choose_boot_playlist_file())
 
         try:
-            path = Path(path_str).expanduser()
-            if not path.is_absolute():
-                path = (PROJECT_DIR / path).resolve()
-            playlist = load_playlist_from_file(path)
+            # playlist recibida por MQTT: se usa en memoria, sin esperar a que
+            # termine de persistirse en disco
+            playlist = st.get("loop_playlist")
+            if playlist is None:
+                playlist = load_playlist_from_file(_resolve_playlist_path(path_str))
         except Exception as e:
             set_state(last_error=str(e))
             publish(mqttc, TOPIC_STATUS, {"event": "error", "error": str(e)}, retain=True)
-            time.sleep(2)
+            _pass_wait(2)
             continue
 
         if not playlist.get("items"):
-            time.sleep(1)
+            _pass_wait(1)
             continue
 
         retries = int(playlist.get("retries", 0))
         black_between = int(playlist.get("black_between", st.get("loop_black_between", 0)))
         show_time = bool(playlist.get("show_time", st.get("show_time", False)))
         schedule_enabled = bool(playlist.get("schedule_enabled", st.get("schedule_enabled", False)))
-        schedule_start = playlist.get("schedule_start", st.get("schedule_start"))
-        schedule_end = playlist.get("schedule_end", st.get("schedule_end"))
+        schedule_start = playlist.get("schedule_start_mod")
+        schedule_end = playlist.get("schedule_end_mod")
 
-        items = list(playlist["items"])
+        # solo se itera: copia únicamente al barajar (la playlist es compartida)
+        items = playlist["items"]
         if playlist.get("shuffle", st.get("loop_shuffle", False)):
-            random.shuffle(items)
+            items = random.sample(items, k=len(items))
 
         if schedule_enabled:
-            within = is_within_schedule(schedule_start, schedule_end)
+            within = is_within_schedule_mod(schedule_start, schedule_end)
             if within and not tv_state_on:
                 ok, detail = tv_power_control("on")
                 tv_state_on = bool(ok)
@@ -754,78 +1575,92 @@ def loop_thread_fn(mqttc):
                 publish(mqttc, TOPIC_STATUS, {"event": "schedule.tv_off", "ok": bool(ok), "detail": detail}, retain=False)
 
             if not within:
-                while not is_within_schedule(schedule_start, schedule_end) and loop_should_run.is_set():
-                    time.sleep(30)
+                # dormir hasta el inicio del horario (tope de 1 h por cambios de hora/reloj)
+                with _mpv_cond:
+                    while not _pass_changed() and not is_within_schedule_mod(schedule_start, schedule_end):
+                        _mpv_cond.wait(min(seconds_until_mod(schedule_start) + 0.05, 3600))
                 continue
 
-        for it in items:
-            if not loop_should_run.is_set():
-                break
-            if schedule_change_event.is_set():
-                break
-            if schedule_enabled and not is_within_schedule(schedule_start, schedule_end):
-                break
-
-            stop_all_event.clear()
-            set_state(current_item=it, paused=False)
-
-            res = handle_item_play(
-                it,
-                retries,
-                publish_fn=lambda p: publish(mqttc, TOPIC_NOWPLAY, p, retain=False),
-                show_time=show_time,
-            )
+        def now_playing(p):
+            publish(mqttc, TOPIC_NOWPLAY, p, retain=False)
 
-            set_state(current_item=None, paused=False)
-            if res == "stopped":
+        for it in items:
+            with _mpv_cond:
+                if _pass_changed():
+                    break
+                play_gen = _play_gen
+            if schedule_enabled and not is_within_schedule_mod(schedule_start, schedule_end):
                 break
 
-            if black_between > 0 and loop_should_run.is_set():
-                remaining = float(black_between)
-                last = time.monotonic()
-                while remaining > 0:
-                    if stop_all_event.is_set():
-                        break
-                    st2 = get_state()
-                    now = time.monotonic()
-                    dt = now - last
-                    last = now
-                    if not st2.get("paused", False):
-                        remaining -= dt
-                    time.sleep(0.05)
+            res = handle_item_play(it, retries, play_gen, publish_fn=now_playing, show_time=show_time)
+
+            with _mpv_cond:
+                if _pass_changed():
+                    break
+                set_state(current_item=None, paused=False)
+
+            if res != "stopped" and black_between > 0 and _loop_enabled:
+                _wait_unpaused(float(black_between))
+
+class DirectJob(NamedTuple):
+    item: dict
+    return_to_loop: bool
+    retries: int
+    show_time: bool
+    # _loop_gen al encolar: si cambia (otro play.once, loop.start/stop) el job
+    # quedó sustituido y no debe arrancar ni devolver el control al loop
+    loop_gen: int = 0
+    # _play_gen al encolar: handle_item_play aborta si hubo otra transición
+    play_gen: int = 0
+
+def _direct_put(job):
+    # el último gana: cada play.once corta lo que suena, y en una ráfaga los
+    # jobs aún pendientes se descartan (la cola nunca pasa de 1)
+    try:
+        while True:
+            direct_queue.get_nowait()
+    except queue.Empty:
+        pass
+    direct_queue.put(job)
 
-def direct_thread_fn(mqttc):
+def _direct_jobs():
     while True:
-        payload = direct_queue.get()
-        if payload is None:
-            continue
-
-        item = payload.get("item")
-        return_to_loop = bool(payload.get("return_to_loop", False))
-        retries = int(payload.get("retries", 0))
-        show_time = bool(payload.get("show_time", get_state().get("show_time", False)))
-
-        stop_all_event.clear()
-        set_state(mode=MODE_DIRECT, current_item=item, paused=False)
-        handle_item_play(item, retries, publish_fn=lambda p: publish(mqttc, TOPIC_NOWPLAY, p, retain=False), show_time=show_time)
-        set_state(current_item=None, paused=False)
+        job = direct_queue.get()
+        if job is _SHUTDOWN:
+            return
+        yield job
 
-        if return_to_loop:
-            set_state(mode=MODE_LOOP)
-            loop_should_run.set()
+def direct_thread_fn(mqttc):
+    def now_playing(p):
+        publish(mqttc, TOPIC_NOWPLAY, p, retain=False)
 
-        direct_queue.task_done()
+    for job in _direct_jobs():
+        if job.loop_gen != _loop_gen:
+            continue
+        handle_item_play(job.item, job.retries, job.play_gen, publish_fn=now_playing, show_time=job.show_time, mode=MODE_DIRECT)
 
-def heartbeat_thread_fn(mqttc):
-    while True:
-        time.sleep(300)
-        publish_status_snapshot(mqttc, event="heartbeat")
+        # comprobar y volver al loop de forma atómica frente a un play.once nuevo;
+        # play.next no cambia _loop_gen, así que sí vuelve
+        with _mpv_cond:
+            if job.loop_gen != _loop_gen:
+                continue
+            set_state(current_item=None, paused=False)
+            if job.return_to_loop:
+                _playback_transition(abort=False, loop=True, mode=MODE_LOOP)
 
 # ----------------------------
 # Lockfile
 # ----------------------------
+_LOCKFILE = Path(tempfile.gettempdir()) / f"pabs-tv-{_safe_name(CLIENT_ID)}.lock"
+
+def _remove_lockfile():
+    try:
+        _LOCKFILE.unlink(missing_ok=True)
+    except Exception:
+        pass
+
 def _install_lockfile():
-    lockfile = Path(tempfile.gettempdir()) / f"pabs-tv-{_safe_name(CLIENT_ID)}.lock"
+    lockfile = _LOCKFILE
     if lockfile.exists():
         try:
             old_pid = int(lockfile.read_text().strip())
@@ -833,41 +1668,175 @@ def _install_lockfile():
             log.error("Ya hay una instancia ejecutándose (PID: %s). Lockfile: %s", old_pid, lockfile)
             sys.exit(1)
         except (ProcessLookupError, ValueError):
-            try:
-                lockfile.unlink()
-            except Exception:
-                pass
+            _remove_lockfile()
 
     try:
         lockfile.write_text(str(os.getpid()))
     except Exception:
         return None
 
-    import atexit
-    def _cleanup():
-        try:
-            if lockfile.exists():
-                lockfile.unlink()
-        except Exception:
-            pass
-
-    atexit.register(_cleanup)
+    atexit.register(_remove_lockfile)
     return lockfile
 
 # ----------------------------
 # MQTT callbacks
 # ----------------------------
-def _coerce_payload_to_dict(payload_text: str):
-    payload_text = (payload_text or "").strip()
-    if not payload_text:
+def _nlower(s):
+    return s.lower() if isinstance(s, str) else ""
+
+def _coerce_payload_to_dict(payload):
+    # acepta bytes (msg.payload tal cual) o str
+    payload = (payload or b"").strip()
+    if not payload:
         return {}
     try:
-        obj = json.loads(payload_text)
+        obj = _json_loads(payload)
         if isinstance(obj, dict):
             return obj
         return {"action": str(obj)}
     except Exception:
-        return {"action": payload_text}
+        if isinstance(payload, (bytes, bytearray)):
+            payload = bytes(payload).decode("utf-8", errors="ignore")
+        return {"action": payload}
+
+# payloads fijos: se construyen una vez; publish solo los serializa (no mutarlos)
+_EVT_PLAY_NEXT = {"event": "play.next", "ok": True}
+_EVT_MISSING_ITEM = {"event": "error", "error": "missing item"}
+_EVT_BAD_RETRIES = {"event": "error", "error": "invalid retries"}
+_EVT_BAD_PLAYLIST = {"event": "error", "error": "invalid playlist"}
+_EVT_DIRECT_ENQUEUED = {"event": "direct.enqueued"}
+
+def _handle_pause(client, data):
+    ok = mpv_set_pause(True)
+    publish_status_snapshot(client, event="player.pause", ok=ok)
+
+def _handle_resume(client, data):
+    ok = mpv_set_pause(False)
+    publish_status_snapshot(client, event="player.resume", ok=ok)
+
+def _handle_toggle(client, data):
+    ok = mpv_toggle_pause()
+    publish_status_snapshot(client, event="player.toggle_pause", ok=ok)
+
+def _handle_next(client, data):
+    _playback_transition()
+    publish(client, TOPIC_STATUS, _EVT_PLAY_NEXT, retain=False)
+
+def _handle_status(client, data):
+    # pedido explícito (status/ping): siempre hay respuesta, aunque no cambie nada
+    publish_status_snapshot(client, event="status", force=True)
+
+def _playlist_shape_ok(pl):
+    # lo que normalize_playlist y loop_thread_fn dan por hecho: items es lista
+    # y los contadores son enteros (si no, el hilo del loop moriría al leerlos)
+    if not isinstance(pl, dict):
+        return False
+    items = pl.get("items", pl.get("list"))
+    if items is not None and not isinstance(items, list):
+        return False
+    try:
+        int(pl.get("retries", 0))
+        int(pl.get("black_between", 0))
+    except (TypeError, ValueError, OverflowError):
+        return False
+    return True
+
+def _handle_loop_start(client, data):
+    playlist = data.get("playlist")
+    playlist_file = data.get("playlist_file")
+
+    if playlist:
+        if not _playlist_shape_ok(playlist):
+            publish(client, TOPIC_STATUS, _EVT_BAD_PLAYLIST, retain=False)
+            return
+        playlist = normalize_playlist(playlist)
+        persist_remote_playlist(playlist)
+        pl_file = str(REMOTE_PLAYLIST_FILE)
+    else:
+        playlist = None
+        if playlist_file:
+            pl_file = str(_resolve_playlist_path(str(playlist_file)))
+        else:
+            pl_file = str(choose_boot_playlist_file())
+
+    _playback_transition(loop=True, mode=MODE_LOOP, paused=False, loop_playlist=playlist, loop_playlist_file=pl_file)
+
+    publish_status_snapshot(client, event="loop.starting")
+
+def _handle_loop_stop(client, data):
+    _playback_transition(loop=False)
+    set_state(loop_running=False, current_src=SRC_NONE, paused=False)
+    publish_status_snapshot(client, event="loop.stopped")
+
+def _handle_play_once(client, data):
+    item = data.get("item")
+    if not item or not isinstance(item, dict):
+        publish(client, TOPIC_STATUS, _EVT_MISSING_ITEM, retain=False)
+        return
+    # validar todo antes de cortar lo que suena: un "retries" inválido no debe
+    # dejar el modo directo sin job ni propagar la excepción al loop de paho
+    try:
+        retries = int(data.get("retries", 0))
+    except (TypeError, ValueError, OverflowError):
+        publish(client, TOPIC_STATUS, _EVT_BAD_RETRIES, retain=False)
+        return
+    if "kind" not in item and "type" in item:
+        item["kind"] = item.pop("type")
+    job = DirectJob(
+        item=item,
+        return_to_loop=bool(data.get("return_to_loop", False)),
+        retries=retries,
+        show_time=bool(data.get("show_time", get_state().get("show_time", False))),
+    )
+
+    play_gen, loop_gen = _playback_transition(loop=False, mode=MODE_DIRECT, paused=False)
+    _direct_put(job._replace(play_gen=play_gen, loop_gen=loop_gen))
+    publish(client, TOPIC_STATUS, _EVT_DIRECT_ENQUEUED, retain=False)
+
+def _handle_tv_power(client, data):
+    state_tv = _nlower(data.get("state"))
+    ok, detail = tv_power_control(state_tv)
+    publish(client, TOPIC_STATUS, {"event": "tv.power", "state": state_tv, "ok": ok, "detail": detail}, retain=False)
+
+def _publish_unknown(client, action):
+    publish(client, TOPIC_STATUS, {"event": "error", "error": f"unknown action: {action}"}, retain=False)
+
+# acción (en minúsculas) -> handler; se resuelve con un solo lookup por mensaje
+_ACTION_HANDLERS = {}
+for _names, _handler in (
+    (("pause", "play.pause", "player.pause", "video.pause"), _handle_pause),
+    # FIX: agregamos "play" y "unpause"
+    (("resume", "play", "unpause", "play.resume", "play.play", "player.play", "video.resume"), _handle_resume),
+    (("toggle", "toggle_pause", "pause.toggle", "play.toggle_pause", "play.pause_toggle"), _handle_toggle),
+    (("play.next", "loop.next", "next"), _handle_next),
+    (("status", "status.request", "ping"), _handle_status),
+    (("loop.start", "loop.set", "playlist.set"), _handle_loop_start),
+    (("loop.stop",), _handle_loop_stop),
+    (("play.once",), _handle_play_once),
+    (("tv.power",), _handle_tv_power),
+):
+    for _name in _names:
+        _ACTION_HANDLERS[sys.intern(_name)] = _handler
+del _names, _handler, _name
+
+def _dispatch_message(client, payload):
+    data = _coerce_payload_to_dict(payload)
+
+    action = data.get("action")
+    action = action.strip() if isinstance(action, str) else ""
+    if action:
+        handler = _ACTION_HANDLERS.get(action.lower())
+        if handler is None:
+            _publish_unknown(client, action)
+            return
+    else:
+        # atajo sin "action": {"state": "on"} / {"power": "off"}
+        stv = _nlower(data.get("state", data.get("power")))
+        if stv not in ("on", "off"):
+            return
+        data["state"] = stv
+        handler = _handle_tv_power
+    handler(client, data)
 
 def main():
     if not MPV or not Path(MPV).exists():
@@ -883,20 +1852,33 @@ def main():
         log.error("Falta paho-mqtt. Instala en el venv: pip install paho-mqtt")
         sys.exit(1)
 
-    mqttc = mqtt.Client(client_id=f"pabs-tv-{CLIENT_ID}", clean_session=True, protocol=mqtt.MQTTv311)
+    # con sesión persistente el broker conserva la suscripción y los comandos QoS1
+    # durante un corte; con id efímero se dejarían sesiones huérfanas
+    persistent = MQTT_PERSISTENT_SESSION and CLIENT_ID_FIXED
+    mqttc = mqtt.Client(client_id=f"pabs-tv-{CLIENT_ID}", clean_session=not persistent, protocol=mqtt.MQTTv311)
     if MQTT_USER and MQTT_PASS:
         mqttc.username_pw_set(MQTT_USER, MQTT_PASS)
+    # las ráfagas de status QoS1 no deben topar con el límite de 20 en vuelo;
+    # la cola offline de paho queda acotada en vez de crecer sin límite
+    mqttc.max_inflight_messages_set(100)
+    mqttc.max_queued_messages_set(1000)
 
-    mqttc.will_set(TOPIC_STATUS, json.dumps({"event": "offline", "client_id": CLIENT_ID}), qos=1, retain=True)
+    mqttc.will_set(TOPIC_STATUS, _json_dumpb({"event": "offline", "client_id": CLIENT_ID}), qos=1, retain=True)
 
     def on_connect(client, userdata, flags, rc):
         log.info("[MQTT] connected rc=%s", rc)
         if rc == 0:
+            try:
+                # sin Nagle: los status son pequeños y no deben esperar al ACK anterior
+                client.socket().setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            except Exception as e:
+                log.warning("[MQTT] no se pudo activar TCP_NODELAY: %s", e)
             mqtt_connected_evt.set()
             set_state(mqtt_connected=True)
-            client.subscribe(TOPIC_CMD, qos=1)
-            publish_status_snapshot(client, event="online")
-            publish(client, TOPIC_STATUS, {"event": "ready", "client_id": CLIENT_ID, "timestamp": datetime.now().strftime("%Y-%m-%d %H:%M:%S")}, retain=True)
+            if not flags.get("session present"):
+                client.subscribe(TOPIC_CMD, qos=1)
+            publish_status_snapshot(client, event="online", force=True)
+            publish(client, TOPIC_STATUS, {"event": "ready", "client_id": CLIENT_ID, "timestamp": _now_str()[0]}, retain=True)
         else:
             mqtt_connected_evt.clear()
             set_state(mqtt_connected=False)
@@ -909,127 +1891,22 @@ def main():
         publish_status_snapshot(client, event="disconnected")
 
     def on_message(client, userdata, msg):
+        if log.isEnabledFor(logging.INFO):
+            # solo los primeros 256 bytes: el log no decodifica payloads enteros
+            try:
+                payload_text = msg.payload[:256].decode("utf-8", errors="replace")
+            except Exception:
+                payload_text = str(msg.payload[:256])
+            log.info("[MQTT][RECV] %s | %s", msg.topic, payload_text)
+        # paho corre en el hilo principal: una excepción aquí tiraría el player
         try:
-            payload_text = msg.payload.decode("utf-8", errors="ignore")
-        except Exception:
-            payload_text = str(msg.payload)
-
-        log.info("[MQTT][RECV] %s | %s", msg.topic, payload_text)
-        data = _coerce_payload_to_dict(payload_text)
-
-        action = (data.get("action") or "").strip()
-        if not action:
-            stv = data.get("state") or data.get("power")
-            if isinstance(stv, str) and stv.lower() in ("on", "off"):
-                action = "tv.power"
-                data["state"] = stv.lower()
-            else:
-                return
-
-        action_l = action.lower().strip()
-
-        pause_actions = {"pause", "play.pause", "player.pause", "video.pause"}
-        # FIX: agregamos "play" y "unpause"
-        resume_actions = {"resume", "play", "unpause", "play.resume", "play.play", "player.play", "video.resume"}
-        toggle_actions = {"toggle", "toggle_pause", "pause.toggle", "play.toggle_pause", "play.pause_toggle"}
-
-        if action_l in pause_actions:
-            ok = mpv_set_pause(True)
-            publish(client, TOPIC_STATUS, {"event": "player.pause", "ok": bool(ok), "paused": True, "src": get_state().get("current_src", "ninguno")}, retain=False)
-            publish_status_snapshot(client, event="status")
-            return
-
-        if action_l in resume_actions:
-            ok = mpv_set_pause(False)
-            publish(client, TOPIC_STATUS, {"event": "player.resume", "ok": bool(ok), "paused": False, "src": get_state().get("current_src", "ninguno")}, retain=False)
-            publish_status_snapshot(client, event="status")
-            return
-
-        if action_l in toggle_actions:
-            ok = mpv_toggle_pause()
-            publish(client, TOPIC_STATUS, {"event": "player.toggle_pause", "ok": bool(ok), "paused": get_state().get("paused", False)}, retain=False)
-            publish_status_snapshot(client, event="status")
-            return
-
-        if action_l in {"play.next", "loop.next", "next"}:
-            stop_all_event.set()
-            time.sleep(0.1)
-            stop_all_event.clear()
-            publish(client, TOPIC_STATUS, {"event": "play.next", "ok": True}, retain=False)
-            return
-
-        if action_l in {"status", "status.request", "ping"}:
-            publish_status_snapshot(client, event="status")
-            return
-
-        if action_l in {"loop.start", "loop.set", "playlist.set"}:
-            stop_all_event.set()
-            loop_should_run.clear()
-            set_state(mode=MODE_LOOP, paused=False)
-
-            playlist = data.get("playlist")
-            playlist_file = data.get("playlist_file")
-
-            if playlist:
-                playlist = normalize_playlist(playlist)
-                persist_remote_playlist(playlist)
-                set_state(loop_playlist_file=str(REMOTE_PLAYLIST_FILE))
-            else:
-                if playlist_file:
-                    pf = Path(str(playlist_file)).expanduser()
-                    if not pf.is_absolute():
-                        pf = (PROJECT_DIR / pf).resolve()
-                    set_state(loop_playlist_file=str(pf))
-                else:
-                    set_state(loop_playlist_file=str(choose_boot_playlist_file()))
-
-            schedule_change_event.set()
-            stop_all_event.clear()
-            loop_should_run.set()
-
-            publish(client, TOPIC_STATUS, {"event": "loop.starting", "src": get_state().get("current_src", "ninguno")}, retain=False)
-            publish_status_snapshot(client, event="status")
-            return
-
-        if action_l == "loop.stop":
-            loop_should_run.clear()
-            stop_all_event.set()
-            _mpv_stop_playback()
-            set_state(loop_running=False, current_src="ninguno", paused=False)
-            publish(client, TOPIC_STATUS, {"event": "loop.stopped", "src": "ninguno"}, retain=False)
-            publish_status_snapshot(client, event="status")
-            return
-
-        if action_l == "play.once":
-            item = data.get("item")
-            if not item or not isinstance(item, dict):
-                publish(client, TOPIC_STATUS, {"event": "error", "error": "missing item"}, retain=False)
-                return
-            if "kind" not in item and "type" in item:
-                item["kind"] = item.pop("type")
-
-            stop_all_event.set()
-            loop_should_run.clear()
-            set_state(mode=MODE_DIRECT, paused=False)
-
-            direct_queue.put(
-                {
-                    "item": item,
-                    "return_to_loop": bool(data.get("return_to_loop", False)),
-                    "retries": int(data.get("retries", 0)),
-                    "show_time": bool(data.get("show_time", get_state().get("show_time", False))),
-                }
-            )
-            publish(client, TOPIC_STATUS, {"event": "direct.enqueued"}, retain=False)
-            return
-
-        if action_l == "tv.power":
-            state_tv = (data.get("state") or "").lower()
-            ok, detail = tv_power_control(state_tv)
-            publish(client, TOPIC_STATUS, {"event": "tv.power", "state": state_tv, "ok": bool(ok), "detail": detail}, retain=False)
-            return
-
-        publish(client, TOPIC_STATUS, {"event": "error", "error": f"unknown action: {action}"}, retain=False)
+            _dispatch_message(client, msg.payload)
+        except Exception as e:
+            log.exception("[MQTT] error procesando comando: %s", e)
+            try:
+                publish(client, TOPIC_STATUS, {"event": "error", "error": f"{e.__class__.__name__}: {e}"}, retain=False)
+            except Exception:
+                pass
 
     mqttc.on_connect = on_connect
     mqttc.on_disconnect = on_disconnect
@@ -1037,25 +1914,50 @@ def main():
 
     mqttc.reconnect_delay_set(min_delay=1, max_delay=30)
 
-    threading.Thread(target=lambda: loop_thread_fn(mqttc), daemon=True).start()
-    threading.Thread(target=lambda: direct_thread_fn(mqttc), daemon=True).start()
-    threading.Thread(target=lambda: heartbeat_thread_fn(mqttc), daemon=True).start()
+    # los workers usan poca pila; evita reservar 8 MiB por hilo (Raspberry Pi)
+    threading.stack_size(WORKER_STACK_SIZE)
+    try:
+        threading.Thread(target=mqtt_publisher_thread_fn, args=(mqttc,), daemon=True).start()
+        threading.Thread(target=persist_thread_fn, daemon=True).start()
+        threading.Thread(target=loop_thread_fn, args=(mqttc,), daemon=True).start()
+        threading.Thread(target=direct_thread_fn, args=(mqttc,), daemon=True).start()
+    finally:
+        threading.stack_size(0)
 
-    set_state(loop_playlist_file=str(choose_boot_playlist_file()))
-    loop_should_run.set()
+    _playback_transition(abort=False, loop=True, loop_playlist_file=str(choose_boot_playlist_file()))
 
     log.info("Iniciando MQTT (connect_async) hacia %s:%s ...", MQTT_HOST, MQTT_PORT)
+    mqtt_started = False
     try:
-        mqttc.connect_async(MQTT_HOST, MQTT_PORT, keepalive=60)
-        mqttc.loop_start()
+        mqttc.connect_async(MQTT_HOST, MQTT_PORT, keepalive=MQTT_KEEPALIVE)
+        mqtt_started = True
     except Exception as e:
         log.error("No se pudo iniciar MQTT async: %s (seguimos offline reproduciendo)", e)
 
-    def _shutdown(_sig=None, _frame=None):
+    def _on_signal(_sig=None, _frame=None):
+        # sin trabajo en contexto de señal (el hilo principal puede tener tomados
+        # locks de paho/mpv): solo corta loop_forever y el cierre va en el finally
+        raise SystemExit(0)
+
+    signal.signal(signal.SIGTERM, _on_signal)
+    signal.signal(signal.SIGINT, _on_signal)
+
+    try:
+        if mqtt_started:
+            # la E/S MQTT corre en el hilo principal en vez de en un hilo extra de paho
+            mqttc.loop_forever(retry_first_connection=True)
+        else:
+            _shutdown_evt.wait()
+    finally:
+        signal.signal(signal.SIGTERM, signal.SIG_IGN)
+        signal.signal(signal.SIGINT, signal.SIG_IGN)
         log.warning("Cerrando PABS-TV...")
+        _shutdown_evt.set()
+        _mqtt_out_q.put(_SHUTDOWN)
         try:
             stop_all_event.set()
-            loop_should_run.clear()
+            _playback_transition(loop=False)
+            direct_queue.put(_SHUTDOWN)
         except Exception:
             pass
         try:
@@ -1063,21 +1965,14 @@ def main():
         except Exception:
             pass
         try:
-            mqttc.disconnect()
+            flush_publishes()
         except Exception:
             pass
         try:
-            mqttc.loop_stop()
+            mqttc.disconnect()
         except Exception:
             pass
         time.sleep(0.2)
-        sys.exit(0)
-
-    signal.signal(signal.SIGTERM, _shutdown)
-    signal.signal(signal.SIGINT, _shutdown)
-
-    while True:
-        time.sleep(1)
 
 if __name__ == "__main__":
     main()
\ No newline at end of file